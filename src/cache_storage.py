@@ -1,7 +1,11 @@
 from typing import Any
+from collections import OrderedDict
 from logger import logger
-from datetime import datetime, timedelta, timezone
-import json
+from datetime import timedelta
+import asyncio
+import orjson
+import time
+import os
 import settings
 
 
@@ -9,58 +13,181 @@ CacheItem = tuple[Any, int]
 
 
 class CacheStorage:
-    def __init__(self, cache_path: str | None = None, item_lifetime: timedelta = timedelta(seconds=10)) -> None:
+    """
+    Key-value cache persisted as an append-only log.
+
+    Each line of the cache file is a `[key, item]` JSON record, the last record of a key wins.
+    The whole log is loaded into `mem_cache` on construction and rewritten (compacted)
+    once the stale records outweigh the live ones.
+    `mem_cache` holds at most `max_items` entries, evicting the least recently used first.
+    """
+
+    # Rewrite the log when it grows beyond this many times the size of its live records
+    COMPACTION_RATIO = 2
+    # Drop expired entries from `mem_cache` every this many sets
+    SWEEP_INTERVAL = 128
+
+    def __init__(
+        self,
+        cache_path: str | None = None,
+        item_lifetime: timedelta = timedelta(seconds=10),
+        max_items: int = 1024,
+    ) -> None:
         self.cache_path: str = cache_path or settings.CACHE_PATH
-        self.mem_cache: dict[str, CacheItem] = {}
+        self.mem_cache: OrderedDict[str, CacheItem] = OrderedDict()
+        self.max_items = max_items
         self.item_lifetime: timedelta = item_lifetime
+        self._lifetime_seconds: float = item_lifetime.total_seconds()
+
+        self._record_sizes: dict[str, int] = {}
+        self._log_size = 0
+        self._live_size = 0
+        self._sets_since_sweep = 0
+        # Serializes appends and compactions on the log file
+        self._file_lock = asyncio.Lock()
+
+        self._load_all()
 
     def _has_expired(self, item: CacheItem) -> bool:
-        return datetime.now(timezone.utc).timestamp() > item[1]
+        return time.time() > item[1]
 
-    def _create_item(self, value: Any) -> CacheItem:
-        new_expiration = datetime.now(timezone.utc) + self.item_lifetime
-        return (value, int(new_expiration.timestamp()))
+    def _create_item(self, value: Any, lifetime: timedelta | None = None) -> CacheItem:
+        lifetime_seconds = self._lifetime_seconds if lifetime is None else lifetime.total_seconds()
+        return (value, int(time.time() + lifetime_seconds))
 
-    def get_item(self, key: str) -> Any | None:
-        if key in self.mem_cache:
-            item = self.mem_cache[key]
+    def _dump_record(self, key: str, item: CacheItem) -> bytes:
+        return orjson.dumps([key, item]) + b'\n'
 
-            if not self._has_expired(item):
-                return item
+    def _track_record(self, key: str, size: int) -> None:
+        self._live_size += size - self._record_sizes.get(key, 0)
+        self._record_sizes[key] = size
 
-        item: CacheItem | None = None
-        try:
-            with open(self.cache_path) as fp:
-                cache: dict[str, Any] = json.load(fp)
-                item = cache.get(key)
+    @staticmethod
+    def _is_valid_record(key: Any, item: Any) -> bool:
+        """Whether `key` and `item` have the `str, [value, expiration]` shape written by `_dump_record`."""
+        return isinstance(key, str) and isinstance(item, list) and len(item) == 2 and isinstance(item[1], int)
 
-        except (FileNotFoundError, json.JSONDecodeError) as error:
-            logger.debug(f'Error loading {self.cache_path}: {error}')
+    def _load_all(self) -> None:
+        # Set when the next append wouldn't start on a line of its own, and would be lost on reload
+        needs_rewrite = False
 
-        if item is None:
+        try:
+            with open(self.cache_path, 'rb') as fp:
+                for line in fp:
+                    self._log_size += len(line)
+
+                    if not line.endswith(b'\n'):
+                        needs_rewrite = True
+
+                    try:
+                        record = orjson.loads(line)
+                    except orjson.JSONDecodeError as error:
+                        # Most likely a record cut short by an interrupted write
+                        logger.debug('Skipping malformed record in %s: %s', self.cache_path, error)
+                        continue
+
+                    # Cache files written before the log format held a single JSON object
+                    if isinstance(record, dict):
+                        needs_rewrite = True
+                        records = list(record.items())
+                    elif isinstance(record, list) and len(record) == 2:
+                        records = [record]
+                    else:
+                        records = [(record, None)]
+
+                    for key, item in records:
+                        # Valid JSON of the wrong shape is skipped like a malformed line
+                        if not self._is_valid_record(key, item):
+                            logger.debug('Skipping malformed record in %s: %r', self.cache_path, line)
+                            needs_rewrite = True
+                            continue
+
+                        self.mem_cache[key] = tuple(item)
+                        self.mem_cache.move_to_end(key)
+                        self._track_record(key, len(self._dump_record(key, item)))
+
+        except FileNotFoundError as error:
+            logger.debug('Error loading %s: %s', self.cache_path, error)
             return
 
-        if self._has_expired(item):
-            return None
+        self._evict_overflow()
 
-        return item[0]
+        if needs_rewrite or self._log_size > self._live_size * self.COMPACTION_RATIO:
+            self._write_log(self._collect_live_records())
 
-    def set_item(self, key: str, value: Any) -> None:
-        item = self._create_item(value)
-        try:
-            with open(self.cache_path, 'r+') as fp:
-                cache: dict[str, Any] = json.load(fp)
-                cache[key] = item
-                fp.seek(0)
-                json.dump(cache, fp)
-                fp.truncate()
+    def _collect_live_records(self) -> bytes:
+        self._record_sizes.clear()
+        self._live_size = 0
+
+        chunks: list[bytes] = []
+        for key, item in list(self.mem_cache.items()):
+            if self._has_expired(item):
+                del self.mem_cache[key]
+                continue
+
+            record = self._dump_record(key, item)
+            chunks.append(record)
+            self._track_record(key, len(record))
+
+        return b''.join(chunks)
+
+    def _write_log(self, data: bytes) -> None:
+        # Write aside and swap so a crash mid-compaction never leaves a truncated log
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(data)
+        os.replace(tmp_path, self.cache_path)
+
+        self._log_size = len(data)
+        logger.debug('Compacted %s: %s live records.', self.cache_path, len(self.mem_cache))
+
+    def _append_record(self, record: bytes) -> None:
+        with open(self.cache_path, 'ab') as fp:
+            fp.write(record)
+
+    def _forget(self, key: str) -> None:
+        self.mem_cache.pop(key, None)
+        self._live_size -= self._record_sizes.pop(key, 0)
+
+    def _evict_overflow(self) -> None:
+        while len(self.mem_cache) > self.max_items:
+            self._forget(next(iter(self.mem_cache)))
+
+    def _sweep_expired(self) -> None:
+        now = time.time()
+        for key, item in list(self.mem_cache.items()):
+            if now > item[1]:
+                self._forget(key)
+
+    def get_item(self, key: str) -> Any | None:
+        item = self.mem_cache.get(key)
+
+        if item is not None and not self._has_expired(item):
+            self.mem_cache.move_to_end(key)
+            return item[0]
+
+        self._forget(key)
+        return None
+
+    async def set_item(self, key: str, value: Any, lifetime: timedelta | None = None) -> None:
+        """`lifetime` overrides `item_lifetime` for this item."""
+        item = self._create_item(value, lifetime)
+        record = self._dump_record(key, item)
 
-        except (FileNotFoundError, json.JSONDecodeError) as error:
-            logger.debug(f'Error loading {self.cache_path}: {error}')
+        async with self._file_lock:
+            await asyncio.to_thread(self._append_record, record)
 
-            with open(self.cache_path, 'w') as fp:
-                json.dump({key: item}, fp)
+            self.mem_cache[key] = item
+            self.mem_cache.move_to_end(key)
+            self._log_size += len(record)
+            self._track_record(key, len(record))
+            self._evict_overflow()
 
-            logger.debug('New cache file created.')
+            self._sets_since_sweep += 1
+            if self._sets_since_sweep >= self.SWEEP_INTERVAL:
+                self._sets_since_sweep = 0
+                self._sweep_expired()
 
-        self.mem_cache[key] = item
+            if self._log_size > self._live_size * self.COMPACTION_RATIO:
+                # Records are collected on the event loop so `mem_cache` is never touched from another thread
+                await asyncio.to_thread(self._write_log, self._collect_live_records())
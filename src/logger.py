@@ -1,26 +1,37 @@
 import logging
 from typing import Callable, ParamSpec, TypeVar
+import stat
 import sys
 import os
 
 
 _log_level = os.environ.get('LOG_LEVEL', 'WARNING')
-assert _log_level, '$LOG_LEVEL env variable is required.'
+if not _log_level:
+    raise RuntimeError('$LOG_LEVEL env variable is required.')
 LOG_LEVEL: int = getattr(logging, _log_level.upper(), logging.WARNING)
 
 _log_file = os.environ.get('LOG_FILE', '/var/log/app/logs.log')
-assert _log_file, '$LOG_FILE env variable is required.'
+if not _log_file:
+    raise RuntimeError('$LOG_FILE env variable is required.')
 
 if not _log_file.startswith('/'):
     _log_file = './' + _log_file
 
-assert not os.path.isdir(_log_file), f'$LOG_FILE must not be a directory: {_log_file}'
-assert os.path.isdir(os.path.dirname(_log_file)), f'$LOG_FILE must be in a valid directory: {_log_file}'
+try:
+    _log_file_is_dir = stat.S_ISDIR(os.stat(_log_file).st_mode)
+except OSError:
+    # Missing or unreachable, the directory check below reports it
+    _log_file_is_dir = False
+
+if _log_file_is_dir:
+    raise RuntimeError(f'$LOG_FILE must not be a directory: {_log_file}')
+if not os.path.isdir(os.path.dirname(_log_file)):
+    raise RuntimeError(f'$LOG_FILE must be in a valid directory: {_log_file}')
 
 LOG_FILE = _log_file
 
 _enable_logging = os.environ.get('ENABLE_LOGGING', 'TRUE')
-ENABLE_LOGGING = _enable_logging and _enable_logging != '0' or _enable_logging.upper() != 'FALSE'
+ENABLE_LOGGING = _enable_logging.upper() not in ('0', 'FALSE', '')
 
 
 _format_per_level = {
@@ -35,16 +46,19 @@ _format_per_level = {
 class FormatterPerLevel(logging.Formatter):
     def __init__(self):
         super().__init__(style='{')
+        self._formatters = {
+            level: logging.Formatter(fmt, style='{')
+            for level, fmt in _format_per_level.items()
+        }
 
     def format(self, record: logging.LogRecord) -> str:
-        self._style._fmt = _format_per_level[record.levelname]
-        return super().format(record)
+        return self._formatters[record.levelname].format(record)
 
 
 _formatter = FormatterPerLevel()
 
 _file_handler = logging.FileHandler(filename=LOG_FILE, mode='a', encoding='utf-8')
-_file_handler.setLevel(LOG_LEVEL if ENABLE_LOGGING else logging.NOTSET)
+_file_handler.setLevel(LOG_LEVEL)
 _file_handler.setFormatter(_formatter)
 
 _stream_handler = logging.StreamHandler(sys.stderr)
@@ -53,7 +67,8 @@ _stream_handler.setFormatter(_formatter)
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-logger.addHandler(_file_handler)
+if ENABLE_LOGGING:
+    logger.addHandler(_file_handler)
 logger.addHandler(_stream_handler)
 
 
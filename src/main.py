@@ -13,14 +13,13 @@ from eyed3.id3.frames import ImageFrame  # type: ignore[reportMissingTypeStubs]
 from eyed3.id3.tag import Tag  # type: ignore[reportMissingTypeStubs]
 
 # Utils
-from typing import Annotated, Literal
-import httpx
+from typing import Annotated, Any, AsyncIterator, Callable, Literal, TypeVar
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from urllib.parse import unquote as url_decode
+import functools
 import asyncio
-import tempfile
-import os
-import time
-import json
+import orjson
 
 # App
 from cache_storage import CacheStorage
@@ -28,11 +27,14 @@ from logger import log_exception, logger
 import settings
 from utils import (
     VideoSearchResult,
+    VideoSearchResultList,
     TrackMetadata,
     PartialTrackMetadata,
+    TempFilePool,
+    http_client,
+    refresh_spotify_api_token_loop,
     search_track_metadata_options,
-    download_youtube_video,
-    convert_mp4_to_mp3
+    download_youtube_audio_as_mp3
 )
 
 
@@ -43,8 +45,60 @@ def get_cache_storage() -> CacheStorage:
 CacheStorageDep = Annotated[CacheStorage, Depends(get_cache_storage)]
 
 
-app = FastAPI(title='Mobile Music Downloader API')
+def load_mock_data(key: Literal['videos', 'tracks']) -> Any:
+    with open('mock.json', 'rb') as fp:
+        return orjson.loads(fp.read())[key]
+
+
+def thumbnail_area(thumbnail: dict[str, Any]) -> int:
+    return thumbnail['width'] * thumbnail['height']
+
+
+def get_vid_info(video: pytube.YouTube) -> dict[str, Any]:
+    return video.vid_info  # type: ignore
+
+
+ReturnType = TypeVar('ReturnType')
+
+# Downloads can take a while, so they get their own threads instead of starving
+# the default executor that handles the short I/O hops (cache writes, `vid_info`, ...).
+# Sized to the temp file pool, which already caps how many downloads run at once.
+download_executor = ThreadPoolExecutor(max_workers=settings.TMP_FILE_POOL_SIZE, thread_name_prefix='download')
+
+
+def run_in_download_executor(func: Callable[..., ReturnType], *args: Any, **kwargs: Any) -> asyncio.Future[ReturnType]:
+    return asyncio.get_running_loop().run_in_executor(download_executor, functools.partial(func, *args, **kwargs))
+
+
+def ignore_task_result(task: asyncio.Future[Any]) -> None:
+    # Reading the exception keeps asyncio from reporting it as never retrieved
+    if not task.cancelled():
+        task.exception()
+
+
+def release_tmp_mp3_file(path: str, worker: asyncio.Future[Any]) -> None:
+    ignore_task_result(worker)
+    mp3_file_pool.release_soon(path)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    token_refresh_task = None
+    if not settings.MOCK_MODE:
+        token_refresh_task = asyncio.create_task(refresh_spotify_api_token_loop(cache_storage))
+
+    yield
+
+    if token_refresh_task is not None:
+        token_refresh_task.cancel()
+    await http_client.aclose()
+    download_executor.shutdown(wait=False, cancel_futures=True)
+    mp3_file_pool.close()
+
+
+app = FastAPI(title='Mobile Music Downloader API', lifespan=lifespan)
 cache_storage = CacheStorage()
+mp3_file_pool = TempFilePool(settings.TMP_FILE_POOL_SIZE, suffix='.mp3')
 
 
 @log_exception
@@ -58,8 +112,7 @@ async def ping() -> Literal['pong!']:
 async def search_videos(cache: CacheStorageDep, query: Annotated[str, Query(description='The value must be urlencoded.')]) -> list[VideoSearchResult]:
     if settings.MOCK_MODE:
         await asyncio.sleep(2)
-        with open('mock.json') as fp:
-            return json.load(fp)['videos']
+        return await asyncio.to_thread(load_mock_data, 'videos')
 
     query = url_decode(query.strip())
     cache_key = 'search_video_' + query.lower()
@@ -67,10 +120,7 @@ async def search_videos(cache: CacheStorageDep, query: Annotated[str, Query(desc
     cached_result: list[dict[str, str]] | None = cache.get_item(cache_key)
     if cached_result is not None:
         try:
-            return [
-                VideoSearchResult.model_validate(result)
-                for result in cached_result
-            ]
+            return VideoSearchResultList.validate_python(cached_result)
         except ValidationError:
             pass
 
@@ -81,21 +131,24 @@ async def search_videos(cache: CacheStorageDep, query: Annotated[str, Query(desc
     if not results:
         return []
 
+    # Each `vid_info` is an HTTP request, so fetch them all at once.
+    # `title` and `author` are then read from the already loaded `vid_info`.
+    vid_infos = await asyncio.gather(*(asyncio.to_thread(get_vid_info, result) for result in results))
+
     final_results = [
         VideoSearchResult(
             video_id=result.video_id,
             watch_url=result.watch_url,
             title=result.title,
             author=result.author,
-            thumbnail_url=sorted(
-                result.vid_info['videoDetails']['thumbnail']['thumbnails'],  # type: ignore
-                key=lambda t: t['width'] * t['height'],  # type: ignore
-                reverse=True
-            )[0]['url'].split('?', 1)[0]
+            thumbnail_url=max(
+                vid_info['videoDetails']['thumbnail']['thumbnails'],
+                key=thumbnail_area
+            )['url'].partition('?')[0]
         )
-        for result in results
+        for result, vid_info in zip(results, vid_infos)
     ]
-    cache.set_item(cache_key, [result.model_dump() for result in final_results])
+    await cache.set_item(cache_key, VideoSearchResultList.dump_python(final_results))
     return final_results
 
 
@@ -113,8 +166,7 @@ async def search_tracks(
 ) -> list[TrackMetadata]:
     if settings.MOCK_MODE:
         await asyncio.sleep(2)
-        with open('mock.json') as fp:
-            return json.load(fp)['tracks']
+        return await asyncio.to_thread(load_mock_data, 'tracks')
 
     partial_metadata = PartialTrackMetadata(
         title=url_decode(title),
@@ -147,7 +199,7 @@ async def search_tracks(
         }
     }
 )
-def download_video_as_mp3(
+async def download_video_as_mp3(
     video_id: Annotated[str, Query()],
     title: Annotated[str, Query()],
     artist: Annotated[str, Query()],
@@ -155,7 +207,7 @@ def download_video_as_mp3(
     album_cover_url: Annotated[str, Query()]
 ) -> FileResponse:
     if settings.MOCK_MODE:
-        time.sleep(4)
+        await asyncio.sleep(4)
         return FileResponse('mock.mp3')
 
     video_id = url_decode(video_id)
@@ -167,20 +219,18 @@ def download_video_as_mp3(
         album_cover_url=url_decode(album_cover_url)
     )
 
-    tmp_mp4_file = tempfile.NamedTemporaryFile(suffix='.mp4', delete=False)
-    tmp_mp4_file.close()
-
-    tmp_mp3_file = tempfile.NamedTemporaryFile(suffix='.mp3', delete=False)
-    tmp_mp3_file.close()
+    tmp_mp3_path = await mp3_file_pool.acquire()
+    # Set once the response owns the file and will release it after it's sent
+    handed_off = False
+    # Last thread writing to the file, it keeps running even if the request is cancelled
+    worker: asyncio.Future[Any] | None = None
 
-    def remove_tmp_files() -> None:
-        os.remove(tmp_mp4_file.name)
-        os.remove(tmp_mp3_file.name)
+    # The cover doesn't depend on the audio, so fetch it while the audio is downloaded and converted
+    album_cover_task = asyncio.create_task(http_client.get(metadata.album_cover_url))
 
     try:
-        download_youtube_video(video_id, tmp_mp4_file.name)
-
-        convert_mp4_to_mp3(mp4_filepath=tmp_mp4_file.name, mp3_filepath=tmp_mp3_file.name)
+        worker = run_in_download_executor(download_youtube_audio_as_mp3, video_id, tmp_mp3_path)
+        await asyncio.shield(worker)
 
         tag = Tag()
 
@@ -188,13 +238,13 @@ def download_video_as_mp3(
         tag.artist = metadata.artist
         tag.album = metadata.album
 
-        response = httpx.get(metadata.album_cover_url)
+        response = await album_cover_task
 
-        if response.status_code not in range(200, 300):
-            logger.error(f'Could not fetch album cover. HTTP code: {response.status_code}')
+        if not 200 <= response.status_code < 300:
+            logger.error('Could not fetch album cover. HTTP code: %s', response.status_code)
 
         tag.images.set(  # type: ignore[reportOptionalMemberAccess]
-            img_data=response.read(),
+            img_data=response.content,
             type_=ImageFrame.FRONT_COVER,
             mime_type='image/jpeg',
             description=f'{metadata.album} Front Cover'
@@ -203,11 +253,26 @@ def download_video_as_mp3(
         # Some music players doesn't recognize the artist when the track doesn't have the "lyrics" tag
         tag.lyrics.set(text='', description='', lang=b'   ')  # type: ignore[reportOptionalMemberAccess]
 
-        tag.save(filename=tmp_mp3_file.name)
+        worker = run_in_download_executor(tag.save, filename=tmp_mp3_path)
+        await asyncio.shield(worker)
 
-        return FileResponse(tmp_mp3_file.name, media_type='audio/mpeg', background=BackgroundTask(remove_tmp_files))
+        file_response = FileResponse(tmp_mp3_path, media_type='audio/mpeg', background=BackgroundTask(mp3_file_pool.release, tmp_mp3_path))
+        handed_off = True
+        return file_response
 
     except Exception:
         logger.exception('Exception downloading youtube track.')
-        remove_tmp_files()
         raise
+
+    finally:
+        # Also runs when the request is cancelled, which `except Exception` doesn't catch
+        if not handed_off:
+            album_cover_task.cancel()
+            # The cover request may have already failed on its own, e.g. with an invalid URL
+            album_cover_task.add_done_callback(ignore_task_result)
+
+            if worker is not None and not worker.done():
+                # Cancelled while the thread is still writing, don't hand the file to another download until it's done
+                worker.add_done_callback(functools.partial(release_tmp_mp3_file, tmp_mp3_path))
+            else:
+                await mp3_file_pool.release(tmp_mp3_path)
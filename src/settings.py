@@ -17,7 +17,8 @@ T = TypeVar('T', str, int, bool)
 def get_env(type_: type[T], key: str, default: str | None = None) -> T:
     value = os.environ.get(key, default)
 
-    assert value is not None, f'${key} env variable is required.'
+    if value is None:
+        raise RuntimeError(f'${key} env variable is required.')
 
     wrong_type_error = TypeError(f'Wrong type for ${key}, must be "{type_}".')
 
@@ -51,3 +52,6 @@ if MOCK_MODE:
     logger.warning('$MOCK_MODE set to True. Using mock data instead.')
 
 CACHE_PATH = get_env(str, 'CACHE_PATH', 'cache.json')
+
+# Max number of downloads converted at the same time, each one needs a temporary file
+TMP_FILE_POOL_SIZE = get_env(int, 'TMP_FILE_POOL_SIZE', '8')
@@ -1,7 +1,7 @@
 # FastAPI
 import subprocess
 from fastapi import HTTPException, status
-from pydantic import BaseModel, ConfigDict, ValidationError, field_validator
+from pydantic import BaseModel, ConfigDict, TypeAdapter, ValidationError, field_validator
 from pydantic.alias_generators import to_camel
 
 # Pytube
@@ -9,9 +9,15 @@ import pytube  # type: ignore[reportMissingTypeStubs]
 import pytube.exceptions  # type: ignore[reportMissingTypeStubs]
 
 # Utils
-from urllib.parse import quote as url_encode
+from urllib.parse import quote_plus as url_encode
 import httpx
-from datetime import datetime, timezone
+import orjson
+from datetime import timedelta
+import asyncio
+import http.client
+import tempfile
+import time
+import io
 import os
 
 # App
@@ -20,6 +26,88 @@ from cache_storage import CacheStorage
 import settings
 
 
+# Shared across requests so connections to Spotify and the album cover hosts are reused.
+# Closed on app shutdown.
+http_client = httpx.AsyncClient(timeout=10.0, limits=httpx.Limits(max_keepalive_connections=32))
+
+
+class TempFilePool:
+    """
+    Bounded pool of reusable temporary files.
+
+    Files are created on demand up to `size` and truncated when released.
+    Once all of them are checked out, `acquire` waits for a release.
+    """
+
+    def __init__(self, size: int, suffix: str = '') -> None:
+        self.size = size
+        self.suffix = suffix
+        self._paths: set[str] = set()
+        self._checked_out: set[str] = set()
+        # Also keeps the running release tasks referenced until they finish
+        self._releasing: dict[str, asyncio.Task[None]] = {}
+        self._available: asyncio.Queue[str] = asyncio.Queue()
+
+    def _create_file(self) -> str:
+        with tempfile.NamedTemporaryFile(suffix=self.suffix, delete=False) as fp:
+            path = fp.name
+        self._paths.add(path)
+        return path
+
+    async def acquire(self) -> str:
+        if self._available.empty() and len(self._paths) < self.size:
+            path = self._create_file()
+        else:
+            path = await self._available.get()
+
+        self._checked_out.add(path)
+        return path
+
+    async def release(self, path: str) -> None:
+        task = self.release_soon(path)
+
+        if task is not None:
+            # Shielded so a cancelled caller can't leave the file half released
+            await asyncio.shield(task)
+
+    def release_soon(self, path: str) -> asyncio.Task[None] | None:
+        """Starts releasing `path` without waiting for it, returns `None` if it isn't checked out."""
+        if path in self._releasing:
+            return self._releasing[path]
+
+        # Releasing twice would hand the same file to two downloads
+        if path not in self._checked_out:
+            return None
+
+        task = asyncio.create_task(self._recycle(path))
+        self._releasing[path] = task
+        return task
+
+    async def _recycle(self, path: str) -> None:
+        available_path = path
+
+        try:
+            await asyncio.to_thread(os.truncate, path, 0)
+        except OSError:
+            # Removed from under us, put a new one in its place so a waiting `acquire` still gets a file
+            logger.warning('Could not reuse temporary file %s, replacing it.', path, exc_info=True)
+            self._paths.discard(path)
+            available_path = self._create_file()
+
+        # Only once the file is ready, so the slot is never lost halfway
+        self._checked_out.discard(path)
+        del self._releasing[path]
+        self._available.put_nowait(available_path)
+
+    def close(self) -> None:
+        for path in self._paths:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        self._paths.clear()
+
+
 class CamelModel(BaseModel):
     model_config = ConfigDict(
         alias_generator=to_camel,
@@ -48,6 +136,11 @@ class TrackMetadata(CamelModel):
     album_cover_url: str
 
 
+# Validate and dump whole lists in a single pydantic-core call
+VideoSearchResultList = TypeAdapter(list[VideoSearchResult])
+TrackMetadataList = TypeAdapter(list[TrackMetadata])
+
+
 class SpotifyAlbumImage(BaseModel):
     url: str
     height: int
@@ -85,61 +178,93 @@ class SpotifyAPIToken(BaseModel):
     @field_validator('expires_at')
     @classmethod
     def validate_expiration_timestamp(cls, expires_at: int) -> int:
-        if expires_at <= datetime.now(timezone.utc).timestamp():
+        if expires_at <= time.time():
             raise ValueError('Token has expired.')
 
         return expires_at
 
 
-async def get_spotify_api_token(cache: CacheStorage | None = None) -> str | None:
-    SPOTIFY_API_TOKEN_CACHE_KEY = 'spotify_api_token'
-
-    if cache is not None:
-        try:
-            cached_token = SpotifyAPIToken.model_validate(cache.get_item(SPOTIFY_API_TOKEN_CACHE_KEY))
-            logger.debug('Spotify token retrieved from cache.')
+SPOTIFY_API_TOKEN_CACHE_KEY = 'spotify_api_token'
+# Fraction of the token lifetime after which the background task refreshes it
+SPOTIFY_API_TOKEN_REFRESH_FACTOR = 0.9
+SPOTIFY_API_TOKEN_RETRY_DELAY = 30
+# Lower bound between refreshes, so a very short-lived token can't make the loop spin
+SPOTIFY_API_TOKEN_MIN_REFRESH_DELAY = 10
 
-            return cached_token.token
-        except ValidationError:
-            pass
 
-    async with httpx.AsyncClient() as client:
-        headers = {
-            'Content-Type': 'application/x-www-form-urlencoded',
-        }
-        content = f'grant_type=client_credentials&client_id={settings.SPOTIFY_API_CLIENT_ID}&client_secret={settings.SPOTIFY_API_CLIENT_SECRET}'
+async def fetch_spotify_api_token(cache: CacheStorage | None = None) -> SpotifyAPIToken | None:
+    headers = {
+        'Content-Type': 'application/x-www-form-urlencoded',
+    }
+    content = f'grant_type=client_credentials&client_id={settings.SPOTIFY_API_CLIENT_ID}&client_secret={settings.SPOTIFY_API_CLIENT_SECRET}'
 
-        response = await client.post(settings.SPOTIFY_API_TOKEN_URL, headers=headers, content=content)
+    response = await http_client.post(settings.SPOTIFY_API_TOKEN_URL, headers=headers, content=content)
 
-    data = response.json()
+    data = orjson.loads(response.content)
 
     if 'error' in data:
-        logger.error('Error fetching a new spotify access token. Error:', data['error'])
+        logger.error('Error fetching a new spotify access token. Error: %s', data['error'])
         return
 
     token = SpotifyAPIToken(
         token=data['access_token'],
-        expires_at=int(datetime.now(timezone.utc).timestamp()) + int(data['expires_in'])
+        expires_at=int(time.time()) + int(data['expires_in'])
     )
 
     if cache:
-        cache.set_item(SPOTIFY_API_TOKEN_CACHE_KEY, token.model_dump())
+        await cache.set_item(SPOTIFY_API_TOKEN_CACHE_KEY, token.model_dump(), lifetime=timedelta(seconds=int(data['expires_in'])))
 
     logger.info('Fetched new Spotify access token.')
-    return token.token
+    return token
+
+
+async def get_spotify_api_token(cache: CacheStorage | None = None) -> str | None:
+    if cache is not None:
+        try:
+            cached_token = SpotifyAPIToken.model_validate(cache.get_item(SPOTIFY_API_TOKEN_CACHE_KEY))
+            logger.debug('Spotify token retrieved from cache.')
+
+            return cached_token.token
+        except ValidationError:
+            pass
+
+    token = await fetch_spotify_api_token(cache)
+    return token.token if token else None
+
+
+async def refresh_spotify_api_token_loop(cache: CacheStorage) -> None:
+    """Keeps a valid token in `cache` so searches don't wait on the token endpoint."""
+    while True:
+        try:
+            token = await fetch_spotify_api_token(cache)
+        except Exception:
+            # Nothing awaits this task, so any error would otherwise stop the refreshes for good
+            logger.exception('Exception refreshing the Spotify access token.')
+            token = None
+
+        if token is None:
+            await asyncio.sleep(SPOTIFY_API_TOKEN_RETRY_DELAY)
+            continue
+
+        await asyncio.sleep(max(
+            (token.expires_at - time.time()) * SPOTIFY_API_TOKEN_REFRESH_FACTOR,
+            SPOTIFY_API_TOKEN_MIN_REFRESH_DELAY
+        ))
 
 
 async def search_track_metadata_options(partial_metadata: PartialTrackMetadata, cache: CacheStorage | None = None) -> list[TrackMetadata]:
-    cache_key = str(partial_metadata).lower()
+    # JSON quotes each field, so different fields can never produce the same key
+    cache_key = 'search_track_' + orjson.dumps([
+        partial_metadata.title.lower(),
+        partial_metadata.artist.lower(),
+        partial_metadata.album.lower() if partial_metadata.album else None,
+    ]).decode()
 
     if cache:
         try:
             cached_metadata: list[dict[str, str]] | None = cache.get_item(cache_key)
             if cached_metadata is not None:
-                return [
-                    TrackMetadata.model_validate(data)
-                    for data in cached_metadata
-                ]
+                return TrackMetadataList.validate_python(cached_metadata)
         except ValidationError:
             pass
 
@@ -150,7 +275,7 @@ async def search_track_metadata_options(partial_metadata: PartialTrackMetadata,
     if partial_metadata.album:
         filters += f' album:{partial_metadata.album}'
 
-    q = url_encode((query + ' ' + filters).replace(' ', '%20'))
+    q = url_encode(query + ' ' + filters)
 
     token = await get_spotify_api_token(cache)
 
@@ -158,19 +283,18 @@ async def search_track_metadata_options(partial_metadata: PartialTrackMetadata,
         logger.error('Could not retrieve spotify access token.')
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    async with httpx.AsyncClient() as client:
-        headers = {
-            'Authorization': f'Bearer {token}'
-        }
-        response = await client.get(settings.SPOTIFY_API_SEARCH_URL + f'?q={q}&type=track&limit=10', headers=headers)
-        logger.debug('Spotify search done.')
+    headers = {
+        'Authorization': f'Bearer {token}'
+    }
+    response = await http_client.get(settings.SPOTIFY_API_SEARCH_URL + f'?q={q}&type=track&limit=10', headers=headers)
+    logger.debug('Spotify search done.')
 
-    if response.status_code not in range(200, 300):
-        logger.error(f'Error fetching the track metadata. HTTP code: {response.status_code}')
+    if not 200 <= response.status_code < 300:
+        logger.error('Error fetching the track metadata. HTTP code: %s', response.status_code)
         return []
 
     try:
-        data = SpotifySearchResponse.model_validate(response.json())
+        data = SpotifySearchResponse.model_validate(orjson.loads(response.content))
     except ValidationError:
         logger.error('Spotify search response with an unexpected format.')
         return []
@@ -186,15 +310,18 @@ async def search_track_metadata_options(partial_metadata: PartialTrackMetadata,
     ]
 
     if cache:
-        value = [model.model_dump() for model in metadata_options]
-        cache.set_item(cache_key, value)
+        value = TrackMetadataList.dump_python(metadata_options)
+        await cache.set_item(cache_key, value)
 
     return metadata_options
 
 
-def download_youtube_video(video_id: str, filepath: str) -> None:
-    if not os.path.isfile(filepath):
-        raise IOError(f'`filepath` must be a valid filepath: {filepath}')
+AUDIO_DOWNLOAD_MAX_ATTEMPTS = 3
+
+
+def download_youtube_audio_as_mp3(video_id: str, mp3_filepath: str) -> None:
+    if not mp3_filepath.endswith('.mp3') or not os.path.isfile(mp3_filepath):
+        raise IOError('`mp3_filepath` must be an existing file with the ".mp3" extension:', mp3_filepath)
 
     try:
         audio_stream = pytube.YouTube.from_id(video_id).streams.get_audio_only('mp4')
@@ -203,30 +330,34 @@ def download_youtube_video(video_id: str, filepath: str) -> None:
             raise pytube.exceptions.VideoUnavailable(video_id)
 
     except pytube.exceptions.VideoUnavailable:
-        logger.debug(f'Youtube video with ID {video_id} not found.')
+        logger.debug('Youtube video with ID %s not found.', video_id)
         raise HTTPException(status.HTTP_404_NOT_FOUND, f'No video found with ID {video_id}')
 
-    logger.debug(f'Downloading audio track: {audio_stream}')
-    audio_stream.download(
-        output_path=os.path.dirname(filepath),
-        filename=os.path.basename(filepath),
-        skip_existing=False,
-        max_retries=3
-    )
-
+    logger.debug('Downloading audio track: %s', audio_stream)
+    buffer = io.BytesIO()
 
-def convert_mp4_to_mp3(mp4_filepath: str, mp3_filepath: str) -> None:
-    if not mp4_filepath.endswith('.mp4') or not os.path.isfile(mp4_filepath):
-        raise IOError('`mp4_filepath` must be an existing file with the ".mp4" extension:', mp4_filepath)
-
-    if not mp3_filepath.endswith('.mp3') or not os.path.isfile(mp3_filepath):
-        raise IOError('`mp3_filepath` must be an existing file with the ".mp3" extension:', mp3_filepath)
-
-    process = subprocess.run(
-        f'{settings.FFMPEG_PATH} -i {mp4_filepath} -ab 320k -y {mp3_filepath}'.split(' '),
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
-    )
+    # `stream_to_buffer` doesn't retry like `download(max_retries=...)` did
+    for attempt in range(1, AUDIO_DOWNLOAD_MAX_ATTEMPTS + 1):
+        try:
+            audio_stream.stream_to_buffer(buffer)
+            break
+        except (OSError, http.client.HTTPException):
+            if attempt == AUDIO_DOWNLOAD_MAX_ATTEMPTS:
+                raise
+
+            logger.warning('Audio track download failed, retrying (%s/%s).', attempt, AUDIO_DOWNLOAD_MAX_ATTEMPTS)
+            buffer.seek(0)
+            buffer.truncate()
+
+    # The mp4 is piped into ffmpeg, so the mp3 is the only file written to disk.
+    # A buffer view avoids copying the whole track.
+    with buffer.getbuffer() as audio:
+        process = subprocess.run(
+            [settings.FFMPEG_PATH, '-loglevel', 'error', '-i', 'pipe:0', '-ab', '320k', '-threads', '0', '-f', 'mp3', '-y', mp3_filepath],
+            input=audio,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
 
     if process.returncode != 0:
         raise Exception('Could not convert mp4 to mp3.')